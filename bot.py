@@ -2,7 +2,7 @@ from discord.ext import commands
 from discord import app_commands
 import google.generativeai as genai
 import discord
-import json
+import httpx
 import logging
 
 from commands.prompt import prompt
@@ -13,9 +13,10 @@ from packages.internet import search_duckduckgo, make_get_request, get_wikipedia
 from packages.weather import get_weather
 from packages.wolfram import wolfram_alpha
 from packages.utils import timeout, hi, execute_code
+from packages.config_cache import get_config, save_temp_config
 
 # Load configuration from config.json
-CONFIG = json.load(open("config.json"))
+CONFIG = get_config()
 
 # Define system prompts and available tools for the bot
 SYSTEM_PROMPTS = CONFIG["SystemPrompts"]
@@ -45,8 +46,11 @@ active_tools = TOOLS[tool_names[active_tools_index]]
 # Set initial model and save temporary configuration
 current_model_index = 0
 model = model_options[current_model_index]
-with open("temp/temp_config.json", "w") as TEMP_CONFIG:
-    TEMP_CONFIG.write(json.dumps({"model": model, "system_prompt": system_prompt_data}, indent=4))
+save_temp_config(model, system_prompt_data)
+
+# HTTP client shared by every file upload and status check, so connections are reused across prompts
+HTTP_CLIENT = httpx.AsyncClient(http2=True, timeout=httpx.Timeout(30, write=300),
+                                limits=httpx.Limits(max_keepalive_connections=32))
 
 # Set up Discord bot with intents
 intents = discord.Intents.default()
@@ -60,6 +64,8 @@ logging.basicConfig(level=logging.INFO,  # Set default logging level
                         logging.FileHandler("bot.log", encoding='utf-8'),  # Log to file
                         logging.StreamHandler()  # Log to console
                     ])
+# httpx logs the URL of every request at INFO, only keep its warnings
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 
 # Event handler for when the bot is ready
@@ -97,9 +103,7 @@ async def toggle(ctx: commands.Context, toggles: str):
         system_prompt_name = changed_system_prompt['Name']
 
         # Save updated configuration to temporary file
-        with open("temp/temp_config.json", "w") as SYS_TEMP_CONFIG:
-            SYS_TEMP_CONFIG.write(
-                json.dumps({"model": selected_model, "system_prompt": changed_system_prompt_data}, indent=4))
+        save_temp_config(selected_model, changed_system_prompt_data)
 
         logging.info(f"Switched to {system_prompt_name}")
 
@@ -114,9 +118,7 @@ async def toggle(ctx: commands.Context, toggles: str):
         current_system_prompt_data = current_system_prompt['SystemPrompt']
 
         # Save updated configuration to temporary file
-        with open("temp/temp_config.json", "w") as SYS_TEMP_CONFIG:
-            SYS_TEMP_CONFIG.write(
-                json.dumps({"model": selected_model, "system_prompt": current_system_prompt_data}, indent=4))
+        save_temp_config(selected_model, current_system_prompt_data)
 
         friendly_name = CONFIG["ModelNames"][selected_model]
         logging.info(f"Switched to {friendly_name}")
@@ -137,7 +139,7 @@ async def toggle(ctx: commands.Context, toggles: str):
 
         # Update the prompt command to use the new active tools
         client.remove_command('prompt')
-        client.add_command(prompt(active_tools))
+        client.add_command(prompt(active_tools, HTTP_CLIENT))
 
 
 # Command to show the currently used model
@@ -153,7 +155,7 @@ async def which(ctx: commands.Context):
     await ctx.reply(f"You are using {friendly_name}", ephemeral=True)
 
 # Add available commands to the bot
-client.add_command(prompt(active_tools))
+client.add_command(prompt(active_tools, HTTP_CLIENT))
 client.add_command(sync)
 client.add_command(thought)
 client.add_command(secret)
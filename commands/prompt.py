@@ -1,25 +1,28 @@
 import ssl
-import json
+import contextvars
+import hashlib
+import httpx
 import datetime
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
 from discord.ext import commands
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
+from google.api_core.exceptions import NotFound
+from google.generativeai import caching
+from google.generativeai.types import HarmCategory
 
+from packages.constants import *
 from packages.utils import *
 from packages.youtube import *
 from packages.tex import *
+from packages.config_cache import *
 
-HARM_BLOCK_THRESHOLD = {
-    "BLOCK_LOW_AND_ABOVE": HarmBlockThreshold.BLOCK_LOW_AND_ABOVE,
-    "BLOCK_MEDIUM_AND_ABOVE": HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    "BLOCK_ONLY_HIGH": HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    "BLOCK_NONE": HarmBlockThreshold.BLOCK_NONE,
-}
-
-CONFIG = json.load(open("config.json"))
+CONFIG = get_config()
 
-YOUTUBE_PATTERN = re.compile(
-    r'https://(www\.youtube\.com/watch\?v=|youtu\.be/)([a-zA-Z0-9_-]+)(?:\S*[&?]list=[^&]+)?(?:&index=\d+)?')
-MAX_MESSAGE_LENGTH = 2000
+# The configured bad words without duplicates or empty entries
+BAD_WORDS = tuple(sorted({word.lower() for word in CONFIG["BadWords"] if word}))
+# Matches any of the bad words regardless of case in a single pass, None if there aren't any
+BAD_WORDS_PATTERN = re.compile(trie_pattern(BAD_WORDS), re.IGNORECASE) if BAD_WORDS else None
 SAFETY_SETTING = HARM_BLOCK_THRESHOLD[CONFIG["HarmBlockThreshold"]]
 SAFETY = {
     HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: SAFETY_SETTING,
@@ -28,14 +31,332 @@ SAFETY = {
     HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: SAFETY_SETTING
 }
 
-thought = ""
-secrets = ""
-output = ""
-ctxGlob = None
-memory = None
+# The context of the prompt being handled, for the tools. Each prompt runs in its own task, so they don't collide
+ctxGlob = contextvars.ContextVar("ctxGlob")
+
+# Explicit context caches of the system prompt and tools by (model, system prompt, tools), None if it can't be cached.
+# The API refuses to cache less than a few thousand tokens, so shorter system prompts are never sent to it.
+CACHE_MIN_CHARACTERS = 4 * 4096
+CACHE_TTL = datetime.timedelta(hours=1)
+system_caches = {}
+# Background extensions of the caches' lifetimes by the same keys, at most one at a time for a cache
+system_cache_refreshes = {}
+
+# Responses to stateless prompts by a hash of the model, system prompt, tools and prompt, as (text, model content)
+response_cache = TTLCache(max_size=1024, ttl=7 * 24 * 60 * 60)
+
+# Responses by (user ID, channel ID, hash of the model, system prompt, tools and final prompt) for a few seconds,
+# so retried and repeated prompts aren't sent again
+recent_responses = TTLCache(max_size=256, ttl=10)
+
+# Models by (model, system prompt, tools, cache), least recently used first. Chats of every channel share them
+MAX_CACHED_MODELS = 16
+models = OrderedDict()
+
+
+@dataclass
+class Session:
+    """
+    The state of the bot in a channel.
+
+    Attributes:
+        key: The (model, system prompt, tools, cache) the chat was started with
+        chat: The chat session holding the history
+        last_used: When the session was last used, in time.monotonic() seconds
+        thought: The bot's latest thoughts
+        secret: The bot's latest kept secrets
+        lock: Held by the prompt using the chat, so the prompts of a channel take their turns one at a time
+    """
+    key: tuple
+    chat: genai.ChatSession
+    last_used: float
+    thought: str = ""
+    secret: str = ""
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
+# Sessions by channel ID, least recently used first. Sessions idle for longer than SESSION_IDLE_TTL seconds are dropped too
+MAX_CACHED_SESSIONS = 256
+SESSION_IDLE_TTL = 6 * 60 * 60
+sessions = OrderedDict()
+
+# Turns of a chat kept in its history. Past MAX_HISTORY_TURNS, it is cut down to the first and latest turns
+MAX_HISTORY_TURNS = 20
+TRIMMED_HISTORY_TURNS = 10
+
+# Prompt size in tokens, without the cached system prompt, from which the older turns of a chat may be summarized.
+# They are only summarized if they hold at least SUMMARY_MIN_TOKENS themselves, since the system prompt and
+# the files of the turns kept as they are count towards the prompt size too
+SUMMARY_TOKEN_THRESHOLD = 32000
+SUMMARY_MIN_TOKENS = 8000
+SUMMARY_KEEP_TURNS = 6
+SUMMARY_PREFIX = "Summary of the conversation so far: "
+SUMMARY_PROMPT = ("Summarize the following conversation in at most 500 tokens. "
+                  "Keep names, IDs, facts and anything that was decided or asked to be remembered.\n\n")
+
+
+async def get_system_cache(model_name: str, system_prompt: str, tools):
+    """
+    Gets the explicit context cache holding the system prompt and tools, creating it when needed.
+    The cache's lifetime is extended in the background once half of it has passed.
+
+    Args:
+        model_name: The name of the model to use
+        system_prompt: The system prompt to cache
+        tools: The tools available to the model
+
+    Returns:
+        The cached content, or None if the system prompt can't be cached.
+    """
+    if len(system_prompt) < CACHE_MIN_CHARACTERS:
+        return None
+
+    key = (model_name, system_prompt, tuple(tools) if isinstance(tools, list) else tools)
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    if key in system_caches:
+        cache = system_caches[key]
+        if cache is None:
+            return None
+        if cache.expire_time - now > CACHE_TTL / 2:
+            return cache
+        if cache.expire_time - now > datetime.timedelta(minutes=1):
+            # The task is kept until it's done, so it isn't garbage collected halfway
+            if key not in system_cache_refreshes:
+                task = asyncio.create_task(refresh_system_cache(cache))
+                system_cache_refreshes[key] = task
+                task.add_done_callback(lambda _: system_cache_refreshes.pop(key, None))
+            return cache
+
+    try:
+        cache = await asyncio.to_thread(caching.CachedContent.create, model=f"models/{model_name}",
+                                        system_instruction=system_prompt, tools=tools, ttl=CACHE_TTL)
+        logging.info(f"Cached the system prompt of {model_name} as {cache.name}")
+    except Exception as e:
+        # Not every model supports caching, don't try again for this one
+        logging.warning(f"Couldn't cache the system prompt of {model_name}: {e}")
+        cache = None
+
+    system_caches[key] = cache
+    return cache
+
+
+async def refresh_system_cache(cache: caching.CachedContent):
+    """
+    Extends the lifetime of a system prompt cache, forgetting it if the server no longer has it.
+
+    Args:
+        cache: The cached content to extend
+    """
+    try:
+        await asyncio.to_thread(cache.update, ttl=CACHE_TTL)
+    except NotFound:
+        logging.warning(f"The cache {cache.name} is gone, it will be created again")
+        forget_system_cache(cache)
+    except Exception as e:
+        logging.warning(f"Couldn't extend the cache {cache.name}: {e}")
+
+
+def forget_system_cache(cache: caching.CachedContent):
+    """
+    Forgets a system prompt cache the server no longer has, so the next prompt creates it again.
+
+    Args:
+        cache: The cached content to forget
+    """
+    for key, cached in list(system_caches.items()):
+        if cached is not None and cached.name == cache.name:
+            del system_caches[key]
+
+
+def check_response(response):
+    """
+    Raises like a response that isn't streamed would, if a streamed response was blocked or cut off.
+    Streamed responses are only checked by the SDK when the history is read, which then fails on every later prompt.
+
+    Args:
+        response: The streamed response, once it has been consumed
+
+    Raises:
+        genai.types.BlockedPromptException: The prompt was blocked
+        genai.types.StopCandidateException: The response was stopped for another reason than finishing or running out of tokens
+    """
+    if not response.candidates:
+        raise genai.types.BlockedPromptException(response.prompt_feedback)
+
+    finish_reason = response.candidates[0].finish_reason
+    if finish_reason not in (genai.protos.Candidate.FinishReason.FINISH_REASON_UNSPECIFIED,
+                             genai.protos.Candidate.FinishReason.STOP,
+                             genai.protos.Candidate.FinishReason.MAX_TOKENS):
+        raise genai.types.StopCandidateException(response.candidates[0])
+
+
+def trim_history(history: list, max_turns: int, keep_turns: int) -> list:
+    """
+    Trims a chat history to its first turn and its latest turns, since the whole history is sent with every prompt.
+    A turn starts at a user message, function calls and their responses stay in the turn they belong to.
+    The history is trimmed well below the limit, so it keeps the same start for several turns and
+    the server can reuse its cache of that prefix.
+
+    Args:
+        history: The history of the chat
+        max_turns: The number of turns from which the history is trimmed
+        keep_turns: The number of turns kept when trimming
+
+    Returns:
+        The trimmed history, or the same list if it is short enough.
+    """
+    turn_starts = [i for i, content in enumerate(history)
+                   if content.role == "user" and not any(part.function_response for part in content.parts)]
+    if len(turn_starts) <= max_turns:
+        return history
+
+    return history[:turn_starts[1]] + history[turn_starts[-(keep_turns - 1)]:]
+
+
+async def summarize_history(model_name: str, history: list, keep_turns: int) -> list:
+    """
+    Replaces the older turns of a chat history by a summary of them, keeping the latest turns as they are.
+    The older turns are left as they are when they are only the previous summary or hold less than SUMMARY_MIN_TOKENS.
+
+    Args:
+        model_name: The name of the model writing the summary
+        history: The history of the chat
+        keep_turns: The number of latest turns to keep
+
+    Returns:
+        The summarized history, or the same list if there isn't enough to summarize or the summary failed.
+    """
+    turn_starts = [i for i, content in enumerate(history)
+                   if content.role == "user" and not any(part.function_response for part in content.parts)]
+    if len(turn_starts) <= keep_turns:
+        return history
+
+    older = history[:turn_starts[-keep_turns]]
+    if len(older) == 2 and older[0].parts and older[0].parts[0].text.startswith(SUMMARY_PREFIX):
+        return history
+
+    try:
+        older_tokens = (await get_model(model_name).count_tokens_async(older)).total_tokens
+    except Exception as e:
+        logging.warning(f"Couldn't count the tokens of the history: {e}")
+        return history
+    if older_tokens < SUMMARY_MIN_TOKENS:
+        return history
+
+    transcript = "\n".join(f"{content.role}: {part.text}" for content in older for part in content.parts if part.text)
+
+    try:
+        response = await get_model(model_name).generate_content_async(SUMMARY_PROMPT + transcript)
+        summary = response.text
+    except Exception as e:
+        logging.warning(f"Couldn't summarize the history: {e}")
+        return history
+
+    logging.info(f"Summarized {len(older)} messages of history")
+    return [genai.protos.Content(role="user", parts=[genai.protos.Part(text=SUMMARY_PREFIX + summary)]),
+            genai.protos.Content(role="model", parts=[genai.protos.Part(text="Got it, I'll keep that in mind.")])] \
+        + history[turn_starts[-keep_turns]:]
+
+
+def get_model(model_name: str, system_prompt: Optional[str] = None, tools=None,
+              cache: Optional[caching.CachedContent] = None) -> genai.GenerativeModel:
+    """
+    Gets the model for a configuration, only creating it the first time it is used.
+
+    Args:
+        model_name: The name of the model to use
+        system_prompt: The system prompt to use, if any
+        tools: The tools available to the model, if any
+        cache: The context cache holding the system prompt and tools, if any
+
+    Returns:
+        The model.
+    """
+    key = (model_name, system_prompt, tuple(tools) if isinstance(tools, list) else tools, cache.name if cache else None)
+    model = models.pop(key, None)
+
+    if model is None:
+        # Initialize the GenAI model with configuration and safety settings
+        if cache:
+            model = genai.GenerativeModel.from_cached_content(cache, safety_settings=SAFETY)
+        else:
+            model = genai.GenerativeModel(model_name, SAFETY, system_instruction=system_prompt, tools=tools)
+
+    models[key] = model
+    while len(models) > MAX_CACHED_MODELS:
+        models.popitem(last=False)
+
+    return model
+
+
+async def get_session(channel_id: int, model_name: str, system_prompt: str, tools,
+                      cache: Optional[caching.CachedContent] = None) -> Session:
+    """
+    Gets the session of a channel, starting one if there isn't any, and waits for its lock.
+    If the model, system prompt or tools changed since the chat was started, it is restarted with the same history.
+    The caller releases session.lock once its turn is in the history.
+
+    Args:
+        channel_id: The ID of the channel
+        model_name: The name of the model to use
+        system_prompt: The system prompt to use
+        tools: The tools available to the model
+        cache: The context cache holding the system prompt and tools, if any
+
+    Returns:
+        The locked session of the channel.
+    """
+    key = (model_name, system_prompt, tools, cache.name if cache else None)
+    now = time.monotonic()
+    session = sessions.pop(channel_id, None)
+
+    if session is None:
+        session = Session(key, get_model(model_name, system_prompt, tools, cache).start_chat(), now)
+
+    session.last_used = now
+    sessions[channel_id] = session
+
+    # The least recently used sessions are first, so stop at the first one that is kept
+    while sessions:
+        oldest_id, oldest = next(iter(sessions.items()))
+        if len(sessions) <= MAX_CACHED_SESSIONS and now - oldest.last_used <= SESSION_IDLE_TTL:
+            break
+        del sessions[oldest_id]
+
+    # The history can only be read once the prompt before has finished its turn
+    await session.lock.acquire()
+    if session.key != key:
+        try:
+            session.chat = get_model(model_name, system_prompt, tools, cache).start_chat(history=session.chat.history)
+        except BaseException:
+            session.lock.release()
+            raise
+        session.key = key
+
+    return session
+
+
+def prompt(tools: list, http_client: httpx.AsyncClient):
+    # Functions the model can call, by name
+    tool_map = {tool.__name__: tool for tool in tools} if isinstance(tools, list) else {}
 
+    async def call_tool(name: str, args):
+        """Calls a function the model asked for, the blocking ones in a thread so the bot keeps responding."""
+        func = tool_map.get(name)
+        if func is None:
+            raise LookupError(f"There is no function named {name}")
+
+        if asyncio.iscoroutinefunction(func):
+            return await func(**args)
+        return await asyncio.to_thread(func, **args)
+
+    # Grounding with Google Search can't take files and adds its sources to the reply
+    grounding = tools == "google_search_retrieval"
+
+    # Names the toolset in the keys of cached responses, they only hold for the tools they were generated with
+    tools_key = f"{','.join(tool_map) if isinstance(tools, list) else tools}|grounding={grounding}"
 
-def prompt(tools: list):
     @commands.hybrid_command(name="prompt")
     async def command(ctx: commands.Context, *, message: str):
         """
@@ -45,181 +366,257 @@ def prompt(tools: list):
             ctx: The context of the command invocation
             message: The message to send the bot
         """
-        global ctxGlob, thought, output, memory, secrets
-        try:
-            # Load configuration from temporary JSON file
-            with open("temp/temp_config.json", "r") as TEMP_CONFIG:
-                configs = json.load(TEMP_CONFIG)
+        if ctx.author.bot:
+            return
 
-            # Initialize the GenAI model with configuration and safety settings
-            model = genai.GenerativeModel(configs['model'], SAFETY_SETTING, system_instruction=configs['system_prompt'],
-                                          tools=tools)
+        # Temporary files to delete once the prompt is handled
+        file_names = []
 
-            # Start a new chat or resume from existing memory
-            chat = model.start_chat(history=memory) if memory else model.start_chat()
-            ctxGlob = ctx
+        # The session, locked while the prompt is handled, and its history before the prompt, to put back if the prompt fails
+        session = None
+        cache = None
+        previous_history = None
+        preview = None
+        succeeded = False
 
-            async with ctx.typing():
-                # Clear context if message is {clear}
-                if message.lower() == "{clear}":
-                    if ctx.author.guild_permissions.administrator:
-                        memory = []
-                        await ctx.reply("Alright, I have cleared my context. What are we gonna talk about?")
-                        logging.info("Cleared Context")
-                        return
-                    else:
-                        await ctx.reply("You don't have the necessary permissions for this!", ephemeral=True)
-
-                # Check for bad words and handle accordingly
-                for word in CONFIG["BadWords"]:
-                    if word in ctx.message.content.lower():
-                        await ctx.message.delete()
-                        await ctx.author.timeout(datetime.timedelta(minutes=10),
-                                                 reason="Saying a word blocked in config.json")
-                        await ctx.send(f"Chill <@{ctx.author.id}>! Don't say things like that.")
-                        return
-
-                logging.info(f"Received Input With Prompt: {message}")
-
-                # Preprocessing and handling attachments/links
-                final_prompt = [YOUTUBE_PATTERN.sub("", message)]
-                file_names = []
-                uploaded_files = []
-
-                link = YOUTUBE_PATTERN.search(message)
-
-                # Download the files and upload them
-                if link and not tools == "google_search_retrieval":
-                    logging.info(f"Found Link {link}")
-                    file_names_from_func, uploaded_files_from_func = await handle_youtube(link)
-
-                    file_names.extend(file_names_from_func)
-                    uploaded_files.extend(uploaded_files_from_func)
+        try:
+            # Check for bad words first, so flagged messages don't cost any setup
+            if BAD_WORDS_PATTERN and BAD_WORDS_PATTERN.search(ctx.message.content):
+                await ctx.message.delete()
+                await ctx.author.timeout(datetime.timedelta(minutes=10),
+                                         reason="Saying a word blocked in config.json")
+                await ctx.send(f"Chill <@{ctx.author.id}>! Don't say things like that.")
+                return
+
+            # Clear context if message is {clear}
+            if message.lower() == "{clear}":
+                if ctx.author.guild_permissions.administrator:
+                    sessions.pop(ctx.channel.id, None)
+                    await ctx.reply("Alright, I have cleared my context. What are we gonna talk about?")
+                    logging.info("Cleared Context")
+                    return
+                else:
+                    await ctx.reply("You don't have the necessary permissions for this!", ephemeral=True)
+                    return
 
-                tasks = [handle_attachment(attachment) for attachment in ctx.message.attachments if not tools == "google_search_retrieval"]
-                results = await asyncio.gather(*tasks)
+            # Load configuration from temporary JSON file, only parsed again after /toggle rewrites it
+            configs = get_temp_config()
 
-                for result in results:
-                    file_names.extend(result[0])
-                    uploaded_files.extend(result[1])
+            # Resume the chat of this channel or start a new one, once the other prompts of the channel are done with it
+            cache = await get_system_cache(configs['model'], configs['system_prompt'], tools)
+            session = await get_session(ctx.channel.id, configs['model'], configs['system_prompt'], tools, cache)
+            chat = session.chat
+            previous_history = list(chat.history)
+            ctxGlob.set(ctx)
 
-                # Waits until the file is active
-                if uploaded_files:
-                    for uploadedFile in uploaded_files:
-                        await wait_for_file_active(uploadedFile)
-                        logging.info(f"{genai.get_file(uploadedFile.name).display_name} is active at server")
-                        final_prompt.append(uploadedFile)
+            async with ctx.typing():
+                logging.info(f"Received Input With Prompt: {message}")
 
-                # Added context, such as the reply and the  user
+                # Added context, such as the reply and the user
                 if ctx.message.reference:
-                    replied = await ctx.channel.fetch_message(ctx.message.reference.message_id)
-                    final_prompt.insert(0,
-                                        f"{ctx.author.name} With Display Name {ctx.author.global_name} and ID {ctx.author.id} Replied To \"{replied.content}\": ")
+                    # Discord usually sends the replied message along, only fetch it when it didn't
+                    replied = ctx.message.reference.resolved
+                    if not isinstance(replied, discord.Message):
+                        replied = await ctx.channel.fetch_message(ctx.message.reference.message_id)
+                    header = f"{ctx.author.name} With Display Name {ctx.author.global_name} and ID {ctx.author.id} Replied To \"{replied.content}\": "
                 else:
-                    final_prompt.insert(0,
-                                        f"{ctx.author.name} With Display Name {ctx.author.global_name} and ID {ctx.author.id}: ")
-
-                if tools == "google_search_retrieval":
-                    final_prompt = final_prompt[0] + final_prompt[1]
-
-                logging.info(f"Got Final Prompt {final_prompt}")
-
-                response = chat.send_message(final_prompt, safety_settings=SAFETY)
+                    header = f"{ctx.author.name} With Display Name {ctx.author.global_name} and ID {ctx.author.id}: "
 
-                func_call_result = {}
-                function_call = False
+                # Preprocessing and handling attachments/links, most messages have no link so skip the regex for them
+                links = list(YOUTUBE_PATTERN.finditer(message)) if "youtu" in message.lower() else []
 
+                # Cut the links out of the message with the matches found, instead of scanning it again
+                stripped_message = []
+                last_end = 0
+                for link in links:
+                    stripped_message.append(message[last_end:link.start()])
+                    last_end = link.end()
+                stripped_message.append(message[last_end:])
 
-                # Loops until there is no more function calling left.
-                while True:
-                    if isinstance(tools, str):
-                        break
-
-                    # Manual function calling system
-                    for part in response.parts:
-                        if fn := part.function_call:
-                            function_call = True
-
-                            # Joins the arguments
-                            arg_output = ", ".join(f"{key}={val}" for key, val in fn.args.items())
-                            logging.info(f"{fn.name}({arg_output})")
-
-                            # Finds the function
-                            func = None
-                            for f in tools:
-                                if f.__name__ == fn.name:
-                                    func = f
-                                    break
+                final_prompt = [header, "".join(stripped_message)]
+                uploaded_files = []
 
-                            args = fn.args
+                # Download the videos and save the attachments, most prompts are text only and have none
+                uploads = []
+                if links and not grounding:
+                    logging.info(f"Found Links {[link.group(0) for link in links]}")
+                    # Each video is downloaded once, and only the first few of them
+                    videos = list({link.group(1): link for link in links}.values())
+                    if len(videos) > MAX_YOUTUBE_VIDEOS:
+                        logging.warning(f"Only using the first {MAX_YOUTUBE_VIDEOS} of {len(videos)} videos")
+                        videos = videos[:MAX_YOUTUBE_VIDEOS]
+                    uploads.extend(handle_youtube(link, http_client) for link in videos)
+                if ctx.message.attachments and not grounding:
+                    uploads.extend(handle_attachment(attachment, http_client) for attachment in ctx.message.attachments)
+
+                # Uploads everything at once, each file is waited on until it's active as soon as it's uploaded
+                if uploads:
+                    results = await asyncio.gather(*(upload_and_wait(upload, http_client) for upload in uploads))
+
+                    for file_names_from_func, uploaded_files_from_func in results:
+                        file_names.extend(file_names_from_func)
+                        uploaded_files.extend(uploaded_files_from_func)
+                    final_prompt.extend(uploaded_files)
+
+                if grounding:
+                    final_prompt = final_prompt[0] + final_prompt[1]
 
-                            # Calls the function
-                            result = func(**args)
-                            func_call_result[fn.name] = result
+                # Logged lazily, the prompt can hold large file objects
+                logging.info("Got Final Prompt %s", final_prompt)
+
+                # A text prompt starting a new chat, that isn't a reply, gets the same answer as an identical earlier one
+                response_key = None
+                if not chat.history and not uploaded_files and not ctx.message.reference and not grounding:
+                    response_key = hashlib.sha256(
+                        "\0".join([configs['model'], configs['system_prompt'], tools_key, *final_prompt]).encode()).hexdigest()
+                cached_response = response_cache.get(response_key) if response_key else None
+
+                # The same user sending the same text prompt again within seconds in the same channel gets the previous answer
+                recent_key = None
+                if not uploaded_files and not grounding:
+                    recent_key = (ctx.author.id, ctx.channel.id, hashlib.blake2b(
+                        "\0".join([configs['model'], configs['system_prompt'], tools_key, repr(final_prompt)]).encode(),
+                        digest_size=16).digest())
+                recent_text = recent_responses.get(recent_key) if recent_key else None
+                prompt_tokens = 0
+
+                if recent_text is not None:
+                    text = recent_text
+                    logging.info(f"Got Repeated Response.\n{text}")
+                elif cached_response:
+                    text, content = cached_response
+                    chat.history = [genai.protos.Content(role="user", parts=[genai.protos.Part(text=part) for part in final_prompt]),
+                                    content]
+                    logging.info(f"Got Cached Response.\n{text}")
+                else:
+                    # Stream the response, so the user can read it while it is being generated
+                    response = await chat.send_message_async(final_prompt, stream=True)
+                    preview = await stream_response(ctx, response, preview, MAX_MESSAGE_LENGTH)
+                    check_response(response)
+
+                    used_tools = False
+
+                    # Loops until there is no more function calling left.
+                    while not isinstance(tools, str):
+                        # Manual function calling system, the calls of this response only
+                        function_calls = [part.function_call for part in response.parts if part.function_call]
+                        if not function_calls:
+                            break
+
+                        used_tools = True
+                        calls = []
+                        for fn in function_calls:
+                            # Joins the arguments, only when they are going to be logged
+                            if logging.getLogger().isEnabledFor(logging.INFO):
+                                arg_output = ", ".join(f"{key}={val}" for key, val in fn.args.items())
+                                logging.info("%s(%s)", fn.name, arg_output)
+
+                            calls.append((fn.name, fn.args))
+
+                        # Calls the functions at once, an unknown one gets an error back like a failed call
+                        results = await asyncio.gather(*(call_tool(name, args) for name, args in calls),
+                                                       return_exceptions=True)
+
+                        func_call_result = []
+                        for (name, _), result in zip(calls, results):
+                            if isinstance(result, Exception):
+                                logging.error(f"Error in {name}: {result}")
+                                result = f"{type(result).__name__}: {result}"
+                            func_call_result.append((name, result))
 
-                    if function_call:
                         # Adds the function calling output
                         # noinspection PyTypeChecker
                         response_parts = [
                             genai.protos.Part(
-                                function_response=genai.protos.FunctionResponse(name=fn, response={"result": val})) for
-                            fn, val in func_call_result.items()
+                                function_response=genai.protos.FunctionResponse(name=name, response={"result": val})) for
+                            name, val in func_call_result
                         ]
-                        response = chat.send_message(response_parts, safety_settings=SAFETY)
-                        function_call = False
-
-                    else:
-                        break
-
-                text = response.text
-                logging.info(f"Got Response.\n{text}")
-
-                memory = chat.history
+                        response = await chat.send_message_async(response_parts, stream=True)
+                        preview = await stream_response(ctx, response, preview, MAX_MESSAGE_LENGTH)
+                        check_response(response)
+
+                    text = response.text
+                    # The cached system prompt is the same for every prompt, it doesn't make the chat long
+                    prompt_tokens = (response.usage_metadata.prompt_token_count
+                                     - response.usage_metadata.cached_content_token_count)
+                    logging.info(f"Got Response.\n{text}")
+
+                    # Answers that came from tools can have side effects or go stale, so they aren't reused
+                    if response_key and not used_tools:
+                        response_cache.set(response_key, (text, response.candidates[0].content))
+                    if recent_key:
+                        recent_responses.set(recent_key, text)
 
                 text, thought_matches, secret_matches = clean_text(text)
-                thought = ""
-                secrets = ""
+                session.thought = "".join(f"{thought_match}\n" for thought_match in thought_matches)
+                session.secret = "".join(f"{secret_match}\n" for secret_match in secret_matches)
                 if thought_matches:
-                    for thought_match in thought_matches:
-                        thought += f"{thought_match}\n"
                     text += "(This reply have a thought)"
-                if secret_matches:
-                    for secret_match in secret_matches:
-                        secrets += f"{secret_match}\n"
-                if tools == "google_search_retrieval":
+                if grounding:
                     text = "### Multi-modality not supported while using the Google Search Retrieval tool.\n" + text + f"\n{create_grounding_markdown(response.candidates)}"
 
-                response_if_tex = split_tex(text)
+                # Most replies have no LaTeX, they don't need to be split
+                response_if_tex = split_tex(text) if "$" in text else [text]
 
                 if len(response_if_tex) > 1:
-                    for i, tex in enumerate(response_if_tex):
-                        if check_tex(tex):
-                            logging.info(tex)
-                            file = render_latex(tex)
-                            file_names.append(file)
-                            response_if_tex[i] = discord.File(file)
+                    # Queue every render at once, so cached images don't wait behind the ones being rendered
+                    tex_indices = [i for i, tex in enumerate(response_if_tex) if check_tex(tex)]
+                    logging.info(f"Rendering {[response_if_tex[i] for i in tex_indices]}")
+                    files = await asyncio.gather(*(render_latex_cached(response_if_tex[i]) for i in tex_indices))
+                    for i, file in zip(tex_indices, files):
+                        response_if_tex[i] = discord.File(file)
+                    if preview:
+                        await preview.delete()
                     await send_long_messages(ctx, response_if_tex, MAX_MESSAGE_LENGTH)
                 else:
-                    await send_long_message(ctx, text, MAX_MESSAGE_LENGTH)
+                    await send_long_message(ctx, text, MAX_MESSAGE_LENGTH, preview)
+
+                # Keep the chat from growing without bound, once the reply is out.
+                # Long chats have their older turns summarized, the rest are trimmed.
+                history = chat.history
+                new_history = history
+                if prompt_tokens > SUMMARY_TOKEN_THRESHOLD:
+                    new_history = await summarize_history(configs['model'], history, SUMMARY_KEEP_TURNS)
+                if new_history is history:
+                    new_history = trim_history(history, MAX_HISTORY_TURNS, TRIMMED_HISTORY_TURNS)
+                if new_history is not history:
+                    chat.history = new_history
+
+            succeeded = True
 
         except ssl.SSLEOFError as e:
             error_message = f"`{e}`\nPerhaps, you can try your request again!"
             logging.error(f"Error: {error_message}")
             await send_long_message(ctx, error_message, MAX_MESSAGE_LENGTH)
 
-        except genai.types.StopCandidateException as e:
+        except NotFound as e:
+            # The system prompt cache expired or was deleted on the server, the next prompt creates it again
+            if cache is not None:
+                forget_system_cache(cache)
+            error_message = f"`{e}`\nPerhaps, you can try your request again!"
+            logging.error(f"Error: {error_message}")
+            await send_long_message(ctx, error_message, MAX_MESSAGE_LENGTH)
+
+        except (genai.types.StopCandidateException, genai.types.BlockedPromptException) as e:
+            # Don't leave the unsafe part that was streamed so far
+            if preview is not None:
+                await preview.delete()
             await send_long_message(ctx, f"{e}\nThat means your prompt isn't safe! Try again!", MAX_MESSAGE_LENGTH)
 
         except Exception as e:
-            await send_long_message(ctx, f"`{e}`", MAX_MESSAGE_LENGTH)
-            logging.error(f"\n{e}")
+            logging.exception("Error while handling prompt")
+            await send_long_message(ctx, f"`{type(e).__name__}: {e}`", MAX_MESSAGE_LENGTH)
 
         finally:
-            try:
-                for file in file_names:
-                    os.remove(file)
-                    logging.info(f"Deleted {os.path.basename(file)} at local server")
-            except UnboundLocalError:
-                pass
+            # A failed prompt leaves a broken response in the chat, which would make every later prompt fail
+            if previous_history is not None and not succeeded:
+                session.chat.history = previous_history
+            if session is not None:
+                session.lock.release()
+
+            # Delete the temporary files off the event loop
+            if file_names:
+                deleted = await asyncio.to_thread(delete_files, file_names)
+                logging.info("Deleted %d files at local server", deleted)
 
     return command
@@ -1,9 +1,8 @@
 from discord.ext import commands
 from discord.app_commands.models import AppCommand
-import json
+from packages.config_cache import get_config
 
-with open('config.json') as f:
-    config = json.loads(f.read())
+config = get_config()
 
 @commands.hybrid_command()
 async def sync(ctx: commands.Context):
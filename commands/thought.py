@@ -3,32 +3,34 @@ from discord.ext import commands
 @commands.hybrid_command()
 async def thought(ctx: commands.Context):
     """
-    Shows what the bot is thinking
+    Shows what the bot is thinking in this channel
 
     Args:
         ctx: The context of the command invocation
     """
-    from commands.prompt import thought
+    from commands.prompt import sessions
     
-    if not thought:
+    session = sessions.get(ctx.channel.id)
+    if session is None or not session.thought:
         await ctx.send("None")
         return
     
-    await ctx.send(thought)
+    await ctx.send(session.thought)
 
 @commands.hybrid_command()
 @commands.has_permissions(administrator=True)
 async def secret(ctx: commands.Context):
     """
-    Shows the bot's kept secret
+    Shows the bot's kept secret in this channel
 
     Args:
         ctx: The context of the command invocation
     """
-    from commands.prompt import secrets
+    from commands.prompt import sessions
     
-    if not secrets:
+    session = sessions.get(ctx.channel.id)
+    if session is None or not session.secret:
         await ctx.send("None", ephemeral=True)
         return
     
-    await ctx.send(secrets, ephemeral=True)
\ No newline at end of file
+    await ctx.send(session.secret, ephemeral=True)
\ No newline at end of file
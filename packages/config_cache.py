@@ -0,0 +1,71 @@
+import os
+
+# orjson parses and writes several times faster, the standard library is the fallback when it isn't installed
+try:
+    import orjson
+    from orjson import loads as json_loads
+
+    def json_dumps(data) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+except ImportError:
+    import json
+    from json import loads as json_loads
+
+    def json_dumps(data) -> bytes:
+        return json.dumps(data, indent=2).encode()
+
+CONFIG_PATH = "config.json"
+TEMP_CONFIG_PATH = os.path.join("temp", "temp_config.json")
+
+# Parsed JSON files by path, as (modification time, data)
+json_cache = {}
+
+
+def load_json_cached(path: str):
+    """
+    Loads a JSON file, only reading and parsing it again when it has been modified since the last load.
+
+    Args:
+        path: The path of the JSON file
+
+    Returns:
+        The parsed JSON data.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    cached = json_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, "rb") as file:
+        data = json_loads(file.read())
+    json_cache[path] = (mtime, data)
+    return data
+
+
+def get_config() -> dict:
+    """
+    Gets the bot's configuration from config.json.
+    """
+    return load_json_cached(CONFIG_PATH)
+
+
+def get_temp_config() -> dict:
+    """
+    Gets the model and system prompt in use from the temporary configuration written by /toggle.
+    """
+    return load_json_cached(TEMP_CONFIG_PATH)
+
+
+def save_temp_config(model_name: str, system_prompt: str):
+    """
+    Saves the model and system prompt in use to the temporary configuration, which the prompt command reads.
+    The cached copy is replaced too, so it doesn't depend on the modification time having changed.
+
+    Args:
+        model_name: The name of the model
+        system_prompt: The system prompt
+    """
+    data = {"model": model_name, "system_prompt": system_prompt}
+    with open(TEMP_CONFIG_PATH, "wb") as file:
+        file.write(json_dumps(data))
+    json_cache[TEMP_CONFIG_PATH] = (os.stat(TEMP_CONFIG_PATH).st_mtime_ns, data)
@@ -0,0 +1,20 @@
+from google.generativeai.types import HarmBlockThreshold
+import re
+
+HARM_BLOCK_THRESHOLD = {
+    "BLOCK_LOW_AND_ABOVE": HarmBlockThreshold.BLOCK_LOW_AND_ABOVE,
+    "BLOCK_MEDIUM_AND_ABOVE": HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+    "BLOCK_ONLY_HIGH": HarmBlockThreshold.BLOCK_ONLY_HIGH,
+    "BLOCK_NONE": HarmBlockThreshold.BLOCK_NONE,
+}
+
+# Matches watch, short, embed, shorts and live links, the video ID is always 11 characters.
+# The link can't start inside another host name (notyoutube.com) and the ID can't be longer than 11 characters.
+# Every repeat either ends at a fixed delimiter or is bounded, so matching stays linear
+YOUTUBE_PATTERN = re.compile(
+    r'(?<![\w.-])(?:https?://)?(?:(?:www|m)\.)?'
+    r'(?:youtu\.be/|youtube(?:-nocookie)?\.com/(?:watch\?(?:[^\s&]*&)*v=|embed/|v/|shorts/|live/))'
+    r'([\w-]{11})(?![\w-])(?:[?&]\S{0,256})?', re.IGNORECASE | re.ASCII)
+# The most YouTube videos downloaded for a single prompt
+MAX_YOUTUBE_VIDEOS = 10
+MAX_MESSAGE_LENGTH = 2000
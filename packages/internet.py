@@ -2,15 +2,15 @@ import requests
 import httpx
 import wikipedia
 import google.generativeai as genai
-import json
 import logging
 
 from bs4 import BeautifulSoup
 from duckduckgo_search import DDGS
 from typing import Any, Dict
 
-with open('config.json') as f:
-    config = json.loads(f.read())
+from packages.config_cache import get_config
+
+config = get_config()
 
 genai.configure(api_key=config['GeminiAPIkey'])
 
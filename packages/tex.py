@@ -1,13 +1,33 @@
 import logging
 from packages.utils import generate_unique_file_name
 
-import matplotlib.pyplot as plt
 from matplotlib import rcParams
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import concurrent.futures
+import functools
+import hashlib
+import asyncio
+import os
 import re
 
+# Renders run on their own threads to keep the event loop free. Each render builds its own figure without pyplot,
+# and most of the time is spent waiting for the LaTeX subprocesses, so a few can run at once
+LATEX_WORKERS = min(4, os.cpu_count() or 1)
+LATEX_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=LATEX_WORKERS, thread_name_prefix="latex")
+LATEX_CACHE_DIR = os.path.join("temp", "latex_cache")
+# The most images kept in the cache, the least recently used ones are deleted past it
+MAX_LATEX_CACHE_FILES = 1000
+
+# Pattern to split the text, keeping the content within dollar signs
+SPLIT_TEX_PATTERN = re.compile(r'(\$.*?\$)|((?:[^$])+)')
+
+# Renders that are queued or running by image file name, so the same LaTeX is never rendered twice at once
+latex_renders = {}
+
 
 def render_latex(latex_string: str, preamble: str=r'\usepackage{amsmath}', padding: int=20, background_color: str="white",
-                 text_color: str="black", dpi: int=300, font_size: int=12):
+                 text_color: str="black", dpi: int=300, font_size: int=12, file_name: str=None):
     r"""Renders a LaTeX string into a PNG image. The PNG file is automatically sent to the user.
 
     Args:
@@ -18,37 +38,37 @@ def render_latex(latex_string: str, preamble: str=r'\usepackage{amsmath}', paddi
         text_color (str, optional): The color of the rendered LaTeX. Defaults to "black".
         dpi (int, optional): The resolution of the output image, in dots per inch. Defaults to 300.
         font_size (int, optional): The font size of the rendered LaTeX. Defaults to 12.
+        file_name (str, optional): Where to save the image. Defaults to a unique file name in the temp folder.
 
     Returns:
         str: The file name of the rendered LaTeX image, or the RuntimeError if the latex_string is invalid.
     """
     try:
 
-        # Set up LaTeX text rendering in matplotlib
-        rcParams['text.usetex'] = True
+        # Set up LaTeX text rendering in matplotlib. Only the preamble is global, the rest is set on the text itself
         rcParams['text.latex.preamble'] = preamble
-        rcParams['font.size'] = font_size
 
         # Initial small figure to calculate text bounding box
-        fig = plt.figure(figsize=(1, 1), dpi=1)
-        text = fig.text(0, 0, latex_string, color=text_color)
-        fig.canvas.draw()  # Render the figure to get accurate text size
-        bbox = text.get_window_extent(fig.canvas.get_renderer())
-
-        # Close the initial figure
-        plt.close(fig)
+        fig = Figure(figsize=(1, 1), dpi=1)
+        canvas = FigureCanvasAgg(fig)
+        text = fig.text(0, 0, latex_string, color=text_color, fontsize=font_size, usetex=True)
+        canvas.draw()  # Render the figure to get accurate text size
+        bbox = text.get_window_extent(canvas.get_renderer())
 
         # Set padding in inches
         padding_inches = padding / dpi  # Convert padding from pixels to inches
 
         # Redefine figure with proper padding and save it
-        fig, ax = plt.subplots(figsize=(bbox.width / dpi + 2 * padding_inches,
-                                        bbox.height / dpi + 2 * padding_inches), dpi=dpi)
+        fig = Figure(figsize=(bbox.width / dpi + 2 * padding_inches,
+                              bbox.height / dpi + 2 * padding_inches), dpi=dpi)
+        FigureCanvasAgg(fig)
         fig.patch.set_facecolor(background_color)
-        ax.text(0.5, 0.5, latex_string, color=text_color, ha='center', va='center', fontsize=font_size)
+        ax = fig.add_subplot()
+        ax.text(0.5, 0.5, latex_string, color=text_color, ha='center', va='center', fontsize=font_size, usetex=True)
         ax.set_axis_off()  # Hide axes
 
-        file_name = fr".\temp\{generate_unique_file_name(r'png')}"
+        if file_name is None:
+            file_name = fr".\temp\{generate_unique_file_name(r'png')}"
 
         # Save the figure with specified settings and padding
         fig.savefig(
@@ -60,7 +80,6 @@ def render_latex(latex_string: str, preamble: str=r'\usepackage{amsmath}', paddi
             pad_inches=padding_inches,
             facecolor=background_color
         )
-        plt.close(fig)
 
         return file_name
 
@@ -69,12 +88,62 @@ def render_latex(latex_string: str, preamble: str=r'\usepackage{amsmath}', paddi
         logging.error(e)
         return e
 
-def split_tex(input_str: str) -> list:
-    # Pattern to split the text, keeping the content within dollar signs
-    pattern = r'(\$.*?\$)|((?:[^$])+)'
+def _prune_cache():
+    # Cache hits touch their image, so the oldest modification times are the least recently used images
+    with os.scandir(LATEX_CACHE_DIR) as entries:
+        images = [entry for entry in entries if entry.name.endswith(".png")]
+    if len(images) <= MAX_LATEX_CACHE_FILES:
+        return
+
+    images.sort(key=lambda entry: entry.stat().st_mtime)
+    for entry in images[:len(images) - MAX_LATEX_CACHE_FILES]:
+        try:
+            os.unlink(entry.path)
+        except FileNotFoundError:
+            pass
+
+def _render_to_cache(latex_string: str, file_name: str):
+    # Render next to the final name and move it in place, so a half written image is never picked up from the cache
+    result = render_latex(latex_string, file_name=f"{file_name}.tmp")
+    if isinstance(result, str):
+        os.replace(result, file_name)
+        _prune_cache()
+        return file_name
+    return result
+
+async def render_latex_cached(latex_string: str):
+    r"""Renders a LaTeX string without blocking the event loop, reusing the image if it was rendered before.
+    Images are cached by the SHA-256 of the LaTeX string, so they should not be deleted after sending.
+    The cache keeps the MAX_LATEX_CACHE_FILES most recently used images.
+
+    Args:
+        latex_string (str): The LaTeX string to render.
+
+    Returns:
+        str: The file name of the rendered LaTeX image, or the RuntimeError if the latex_string is invalid.
+    """
+    file_name = os.path.join(LATEX_CACHE_DIR, f"{hashlib.sha256(latex_string.encode()).hexdigest()}.png")
+    try:
+        # Marks the image as recently used
+        os.utime(file_name)
+        return file_name
+    except FileNotFoundError:
+        pass
+
+    render = latex_renders.get(file_name)
+    if render is None:
+        os.makedirs(LATEX_CACHE_DIR, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        render = loop.run_in_executor(LATEX_EXECUTOR, functools.partial(_render_to_cache, latex_string, file_name))
+        latex_renders[file_name] = render
+        render.add_done_callback(lambda _: latex_renders.pop(file_name, None))
 
+    # Shielded, so a cancelled prompt doesn't cancel a render another one is waiting for
+    return await asyncio.shield(render)
+
+def split_tex(input_str: str) -> list:
     # Split the text using the pattern
-    split_parts = re.findall(pattern, input_str)
+    split_parts = SPLIT_TEX_PATTERN.findall(input_str)
 
     # Flatten the list and remove empty strings
     result = [item for sublist in split_parts for item in sublist if item]
@@ -5,16 +5,29 @@ import string
 import discord
 import asyncio
 import logging
-import sys
 import io
+import os
 import re
-import nest_asyncio
+import threading
+from contextlib import redirect_stdout, redirect_stderr
+from collections import OrderedDict
 import google.ai.generativelanguage_v1beta.types.generative_service
 
 from packages.maps import subscript_map, superscript_map
 
 
-nest_asyncio.apply()
+# Everything clean_text handles: thoughts and secrets, sub/superscripts and stray line breaks
+CLEAN_TEXT_PATTERN = re.compile(r"<(thought|store)>[\s\S]*?</\1>|<(sub|sup)>(.*?)</\2>|\n<br>")
+SUB_SUP_PATTERN = re.compile(r"<(sub|sup)>(.*?)</\1>")
+
+# Seconds between edits of a streamed reply, Discord allows 5 edits per 5 seconds on a message
+STREAM_EDIT_INTERVAL = 1.2
+
+# The most attachments Discord accepts on a message
+MAX_FILES_PER_MESSAGE = 10
+
+# Code is run with sys.stdout and sys.stderr redirected, they are shared by the whole process so one piece runs at a time
+RUN_CODE_LOCK = threading.Lock()
 
 def generate_unique_file_name(extension):
     """
@@ -24,35 +37,131 @@ def generate_unique_file_name(extension):
     random_str = ''.join(random.choices(string.ascii_letters + string.digits, k=8))
     return f"{timestamp}_{random_str}.{extension}"
 
+def delete_files(file_names: list) -> int:
+    """
+    Deletes files one after the other, skipping the ones that are already gone.
+    Meant to run in a thread, so a single thread does all the deleting.
+
+    Returns:
+        The number of files deleted.
+    """
+    deleted = 0
+    for file_name in file_names:
+        try:
+            os.unlink(file_name)
+            deleted += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.error(f"Couldn't delete {file_name}: {e}")
+    return deleted
+
+def trie_pattern(words) -> str:
+    """
+    Builds a regex pattern matching any of the words, with the words merged into a trie.
+    Words sharing a prefix share its branch, so each position of the text is matched once instead of once per word.
+
+    Args:
+        words: The words to match
+
+    Returns:
+        The regex pattern.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def to_pattern(node: dict) -> str:
+        branches = [re.escape(char) + to_pattern(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+
+        pattern = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        # A word ends here, the rest of the branch is optional
+        if "" in node:
+            pattern = f"(?:{pattern})?" if len(branches) == 1 else f"{pattern}?"
+        return pattern
+
+    return to_pattern(trie)
+
+class TTLCache:
+    """
+    A least recently used cache whose entries expire after a fixed time.
+
+    Attributes:
+        max_size: The maximum number of entries kept.
+        ttl: How long an entry stays valid, in seconds.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size: int = max_size
+        self.ttl: float = ttl
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        Gets a value, or the default if the key isn't cached or has expired.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+
+        if time.monotonic() - entry[0] > self.ttl:
+            del self._entries[key]
+            return default
+
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, value):
+        """
+        Caches a value, evicting the least recently used entries when full.
+        """
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
 def clean_text(text: str):
     """
-    Replaces <sub></sub> and <sup></sup> tags with their Unicode subscript and superscript equivalents.
+    Replaces <sub></sub> and <sup></sup> tags with their Unicode subscript and superscript equivalents,
+    and takes <thought></thought> and <store></store> blocks out of the text, in a single pass.
 
     Args:
         text: The input string containing <sub></sub> and <sup></sup> tags.
 
     Returns:
-        The string with the tags replaced by subscript and superscript characters.
+        The string with the tags replaced by subscript and superscript characters, the thoughts and the secrets.
     """
-    def replace_sub(m):
-        return ''.join(subscript_map.get(c, c) for c in m.group(1))
+    # Every tag starts with "<", most replies have none and don't need the regex
+    if "<" not in text:
+        return text, [], []
 
-    def replace_sup(m):
-         return ''.join(superscript_map.get(c, c) for c in m.group(1))
+    thought_matches = []
+    secret_matches = []
 
-    text = re.sub(r'<sub>(.*?)</sub>', replace_sub, text)
-    text = re.sub(r'<sup>(.*?)</sup>', replace_sup, text)
-    
-    thought_matches = re.findall(r"<thought>[\s\S]*?</thought>", text)
-    secret_matches = re.findall(r"<store>[\s\S]*?</store>", text)
-    text = re.sub(r"<thought>[\s\S]*?</thought>", "", text)
-    text = re.sub(r"<store>[\s\S]*?</store>", "", text)
-    text = re.sub(r"\n<br>", "", text)
-    
-    return text, thought_matches, secret_matches
+    def replace_sub_sup(tag, content):
+        script_map = subscript_map if tag == "sub" else superscript_map
+        return ''.join(script_map.get(c, c) for c in content)
+
+    def replace(m):
+        if m.group(1):
+            # Thoughts and secrets leave the text, with their own sub/superscripts converted
+            block = SUB_SUP_PATTERN.sub(lambda n: replace_sub_sup(n.group(1), n.group(2)), m.group(0))
+            (thought_matches if m.group(1) == "thought" else secret_matches).append(block)
+            return ""
+        if m.group(2):
+            return replace_sub_sup(m.group(2), m.group(3))
+        return ""
 
-async def send_long_message(ctx, message, length):
-    """Sends a long message in chunks, splitting at the nearest space within the length limit."""
+    return CLEAN_TEXT_PATTERN.sub(replace, text), thought_matches, secret_matches
+
+def split_message(message: str, length: int) -> list[str]:
+    """Splits a message into chunks of at most `length` characters, splitting at the nearest space."""
+    chunks = []
     start = 0
     while start < len(message):
         end = min(start + length, len(message))  # Initial end position
@@ -63,18 +172,101 @@ async def send_long_message(ctx, message, length):
             if last_space != -1:
                 end = last_space  # Split at the last space
 
-        await ctx.reply(message[start:end])
+        chunks.append(message[start:end])
         start = end + 1  # Move start to the next character after the split
 
+    return chunks
+
+def preview_text(text: str) -> str:
+    """Cleans a partial response for display, hiding thoughts and secrets that are still being written."""
+    text = clean_text(text)[0]
+    for tag in ("<thought>", "<store>"):
+        index = text.find(tag)
+        if index != -1:
+            text = text[:index]
+    return text.strip()
+
+async def stream_response(ctx, response, preview=None, length=2000):
+    """
+    Consumes a streamed response, showing what has been generated so far in a preview message.
+    The preview is edited at most once every STREAM_EDIT_INTERVAL seconds to stay within Discord's rate limits.
+
+    Args:
+        ctx: The context of the command invocation
+        response: The streamed response
+        preview: The preview message to edit, if one has been sent already
+        length: The maximum length of a message
+
+    Returns:
+        The preview message, or None if there was nothing to show.
+    """
+    text = ""
+    last_edit = 0
+    async for chunk in response:
+        if not chunk.candidates:
+            continue
+        text += "".join(part.text for part in chunk.candidates[0].content.parts)
+
+        if time.monotonic() - last_edit < STREAM_EDIT_INTERVAL:
+            continue
+
+        shown = preview_text(text)
+        if not shown:
+            continue
+        if len(shown) > length:
+            shown = "…" + shown[-(length - 1):]
+
+        if preview is None:
+            preview = await ctx.reply(shown)
+        else:
+            await preview.edit(content=shown)
+        last_edit = time.monotonic()
+
+    return preview
+
+async def send_long_message(ctx, message, length, preview=None):
+    """
+    Sends a long message in chunks, splitting at the nearest space within the length limit.
+    If a preview of the message was streamed, it is replaced by the first chunk.
+    """
+    chunks = split_message(message, length)
+    if not chunks:
+        if preview is not None:
+            await preview.delete()
+        return
+
+    # Reply with the first chunk right away, the rest follow in order
+    if preview is not None:
+        await preview.edit(content=chunks[0])
+    else:
+        await ctx.reply(chunks[0])
+    for chunk in chunks[1:]:
+        await ctx.send(chunk)
+
 async def send_long_messages(ctx, messages, length):
-    """Sends a long list of message in chunks, splitting at the nearest space within the length limit."""
+    """
+    Sends a long list of message in chunks, splitting at the nearest space within the length limit.
+    Consecutive files are sent together, up to MAX_FILES_PER_MESSAGE in a message.
+    """
+    files = []
     for message in messages:
+        if isinstance(message, discord.File):
+            files.append(message)
+            if len(files) == MAX_FILES_PER_MESSAGE:
+                await ctx.reply(files=files)
+                files = []
+            continue
+
+        if files:
+            await ctx.reply(files=files)
+            files = []
         if isinstance(message, str):
             await send_long_message(ctx, message, length)
-        elif isinstance(message, discord.File):
-            await ctx.reply(file=message)
+
+    if files:
+        await ctx.reply(files=files)
         
-def timeout(member_id: int, duration: int = 60, reason: str = None):
+async def timeout(member_id: int, duration: int = 60, reason: str = None):
     """Timeouts a Discord member using their ID for a specified duration. Do not use scientific notation. (It actually works)
 
         Args:
@@ -82,57 +274,72 @@ def timeout(member_id: int, duration: int = 60, reason: str = None):
             duration: Duration in seconds. Default is 60 seconds.
             reason: The reason why the user is timed out.
     """
-    async def _mute(mem_id: int, dur: int, r: str = None):
-        if dur <= 0:
-            return "Time must be a positive integer"
-        
-        from commands.prompt import ctxGlob
-        
-        guild = ctxGlob.guild
-        try:
-            member = await guild.fetch_member(mem_id)
-            if member is None:
-                await ctxGlob.send("Member not found in this server.")
-                return
-
-            await member.timeout(timedelta(seconds=dur), reason=r)
-            await ctxGlob.send(f"Member with ID {mem_id} has been timed out for {dur} seconds. Reason: {r}")
-            return f"Successful! Member with ID {mem_id} has been timed out for {dur} seconds. Reason: {r}"
-        except discord.Forbidden:
-            await ctxGlob.send("Missing Permission!")
-            return "Missing Permissions. Ping <@578997249741160467> to fix."
-        except discord.HTTPException as e:
-            await ctxGlob.send(e)
-            return f"Something Happened. {e}"
-        
-    loop = asyncio.get_running_loop() 
-    return loop.run_until_complete(_mute(member_id, duration, reason))
+    if duration <= 0:
+        return "Time must be a positive integer"
 
-def send(message: str):
-    async def _send(msg):
-        from commands.prompt import ctxGlob
-        await ctxGlob.send(msg)
-        
-    loop = asyncio.get_running_loop() 
-    loop.run_until_complete(_send(message))
-    
-def reply(message: str):
-    async def _reply(msg):
-        from commands.prompt import ctxGlob
-        await ctxGlob.reply(msg)
-    
-    loop = asyncio.get_running_loop() 
-    loop.run_until_complete(_reply(message))
-    
-def hi():
+    from commands.prompt import ctxGlob
+    ctx = ctxGlob.get()
+
+    guild = ctx.guild
+    try:
+        member = await guild.fetch_member(member_id)
+        if member is None:
+            await ctx.send("Member not found in this server.")
+            return
+
+        await member.timeout(timedelta(seconds=duration), reason=reason)
+        await ctx.send(f"Member with ID {member_id} has been timed out for {duration} seconds. Reason: {reason}")
+        return f"Successful! Member with ID {member_id} has been timed out for {duration} seconds. Reason: {reason}"
+    except discord.Forbidden:
+        await ctx.send("Missing Permission!")
+        return "Missing Permissions. Ping <@578997249741160467> to fix."
+    except discord.HTTPException as e:
+        await ctx.send(e)
+        return f"Something Happened. {e}"
+
+async def send(message: str):
+    from commands.prompt import ctxGlob
+    await ctxGlob.get().send(message)
+
+async def reply(message: str):
+    from commands.prompt import ctxGlob
+    await ctxGlob.get().reply(message)
+
+async def hi():
     """
     A test function that says hi.
     """
-    send("SassBot Said Hi!")
+    await send("SassBot Said Hi!")
     logging.info("SassBot Said Hi!")
     return "SassBot Said Hi!"
-    
-def execute_code(code_string: str):
+
+def run_code(code_string: str):
+    """
+    Runs Python code and captures what it writes, blocking until it finishes.
+    Only one piece of code runs at a time, the others wait for it.
+
+    Returns:
+        The captured standard output, and the captured standard error or None if the code didn't raise.
+    """
+    captured_stdout = io.StringIO()
+    captured_stderr = io.StringIO()
+
+    # Use provided global_namespace or create a new one
+    global_namespace = {}
+
+    # Redirect stdout and stderr to capture output, they are restored when leaving the block
+    with RUN_CODE_LOCK, redirect_stdout(captured_stdout), redirect_stderr(captured_stderr):
+        try:
+            # Execute the code in the custom global namespace
+            exec(code_string, global_namespace)
+        except Exception as e:
+            # Capture the error message
+            captured_stderr.write(f"Error during code execution: {e}")
+            return captured_stdout.getvalue(), captured_stderr.getvalue()
+
+    return captured_stdout.getvalue(), None
+
+async def execute_code(code_string: str):
     """Executes Python code from a string and captures the output.
 
     Args:
@@ -145,34 +352,20 @@ def execute_code(code_string: str):
     
     logging.info('\n' + encoded_string)
 
-    # Redirect stdout and stderr to capture output
-    old_stdout = sys.stdout
-    old_stderr = sys.stderr
-    sys.stdout = captured_stdout = io.StringIO()
-    sys.stderr = captured_stderr = io.StringIO()
+    # The code can take a while, it runs in a thread so the bot keeps responding
+    output, error = await asyncio.to_thread(run_code, encoded_string)
 
-    # Use provided global_namespace or create a new one
-    global_namespace = {}
-    try:
-        # Execute the code in the custom global namespace
-        exec(encoded_string, global_namespace)
-    except Exception as e:
-        # Capture the error message
-        captured_stderr.write(f"Error during code execution: {e}") 
-        final = f"Code:\n```py\n{encoded_string}\n```\nError:`{captured_stderr.getvalue()}`"
+    if error is not None:
+        final = f"Code:\n```py\n{encoded_string}\n```\nError:`{error}`"
         
-        logging.info(captured_stderr.getvalue())
-        reply(final)
+        logging.info(error)
+        await reply(final)
         
-        return captured_stderr.getvalue()
-    finally:
-        # Restore stdout and stderr
-        sys.stdout = old_stdout
-        sys.stderr = old_stderr
-
-    final = f"Code:\n```py\n{encoded_string}\n```\nOutput:\n```\n{captured_stdout.getvalue()}\n```"
-    reply(final)
-    return captured_stdout.getvalue()
+        return error
+
+    final = f"Code:\n```py\n{encoded_string}\n```\nOutput:\n```\n{output}\n```"
+    await reply(final)
+    return output
 
 def create_grounding_markdown(candidates: google.ai.generativelanguage_v1beta.types.generative_service.Candidate):
     """
@@ -2,12 +2,9 @@ import httpx
 import xmltodict
 import re
 from typing import Dict, Any, List
-import json
 import logging
-import nest_asyncio
-import asyncio
 
-nest_asyncio.apply()
+from packages.config_cache import get_config
 
 class WolframAlphaAPI:
     """
@@ -154,7 +151,7 @@ class WolframAlphaFullAPI(WolframAlphaAPI):
         return doc['queryresult']
 
 
-def wolfram_alpha(query: str, show_steps: bool = False, raw: bool = False):
+async def wolfram_alpha(query: str, show_steps: bool = False, raw: bool = False):
     """
     Sends a query to the Wolfram Alpha API. WolframAlpha can answer the simplest math questions to hard math questions.
     
@@ -166,10 +163,9 @@ def wolfram_alpha(query: str, show_steps: bool = False, raw: bool = False):
     Returns:
         A dictionary representing the query result.
     """
-    client = WolframAlphaFullAPI(json.load(open("config.json"))['WolframAPI'])
+    client = WolframAlphaFullAPI(get_config()['WolframAPI'])
     
-    loop = asyncio.get_running_loop()
-    output = loop.run_until_complete(client.query(query, show_steps))
+    output = await client.query(query, show_steps)
     
     logging.info(output)
     
@@ -1,11 +1,23 @@
 from pytubefix import YouTube
 import asyncio, re
 import google.generativeai as genai
+import httpx
+import json
 import logging
+import mimetypes
 import os
 import time
 
 from packages.utils import generate_unique_file_name
+from packages.config_cache import get_config
+
+config = get_config()
+
+UPLOAD_URL = "https://generativelanguage.googleapis.com/upload/v1beta/files"
+FILES_URL = "https://generativelanguage.googleapis.com/v1beta/"
+
+# Size of the pieces files are uploaded in, so a file is never read into memory as a whole
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
 def download_video(link: str):
     """
@@ -15,6 +27,43 @@ def download_video(link: str):
 
     return video
 
+async def read_chunks(path: str):
+    """
+    Reads a file in pieces of UPLOAD_CHUNK_SIZE bytes, each in a thread so the event loop isn't blocked.
+    """
+    with open(path, "rb") as file:
+        while chunk := await asyncio.to_thread(file.read, UPLOAD_CHUNK_SIZE):
+            yield chunk
+
+async def upload_file(path: str, client: httpx.AsyncClient):
+    """
+    Uploads a file to the Gemini Files API without blocking the event loop.
+    Mirrors `genai.upload_file`, but talks to the resumable upload endpoint directly.
+    """
+    mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    size = await asyncio.to_thread(os.path.getsize, path)
+
+    # Start the upload session
+    start = await client.post(UPLOAD_URL, headers={
+        "x-goog-api-key": config['GeminiAPIkey'],
+        "X-Goog-Upload-Protocol": "resumable",
+        "X-Goog-Upload-Command": "start",
+        "X-Goog-Upload-Header-Content-Length": str(size),
+        "X-Goog-Upload-Header-Content-Type": mime_type,
+    }, json={"file": {"display_name": os.path.basename(path)}})
+    start.raise_for_status()
+
+    # Stream the bytes and finalize in a single request
+    upload = await client.post(start.headers["x-goog-upload-url"], headers={
+        "Content-Length": str(size),
+        "X-Goog-Upload-Offset": "0",
+        "X-Goog-Upload-Command": "upload, finalize",
+    }, content=read_chunks(path))
+    upload.raise_for_status()
+
+    file = genai.protos.File.from_json(json.dumps(upload.json()["file"]), ignore_unknown_fields=True)
+    return genai.types.File(file)
+
 def search_regex(pattern: str, text: str):
     """
     Searches for a regex pattern in a text and returns the match if found.
@@ -25,34 +74,49 @@ def search_regex(pattern: str, text: str):
         return link
     return None
 
-def check_for_file_active(uploaded_file):
+async def check_for_file_active(uploaded_file, client: httpx.AsyncClient):
     """
     Checks if the uploaded file is active on Google servers.
     """
-    status = genai.get_file(uploaded_file.name).state
-    return status == 2
+    response = await client.get(FILES_URL + uploaded_file.name, headers={"x-goog-api-key": config['GeminiAPIkey']})
+    response.raise_for_status()
+    return response.json().get("state") == "ACTIVE"
 
-async def wait_for_file_active(uploaded_file_to_check):
+async def wait_for_file_active(uploaded_file_to_check, client: httpx.AsyncClient):
     """
     Waits until the uploaded file becomes active on Google servers.
     """
     start_time = time.monotonic()
     timeout = 30
+    delay = 0.25
 
     try:
-        while not check_for_file_active(uploaded_file_to_check):
+        while not await check_for_file_active(uploaded_file_to_check, client):
             if time.monotonic() - start_time >= timeout:
                 logging.warning(f"Timeout while waiting for file {uploaded_file_to_check.name} to become active. Skipping Check")
                 return 
 
-            await asyncio.sleep(1)  
-                
+            # Back off exponentially, small files are usually active within the first checks
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 2)
+
+        logging.info(f"{uploaded_file_to_check.display_name} is active at server")
     except Exception as e:
         logging.error(f"Error while waiting for file active! {e}.")
         
-async def handle_youtube(link):
+async def upload_and_wait(upload, client: httpx.AsyncClient):
+    """
+    Waits for an upload from handle_youtube or handle_attachment, then until its files are active.
+    Each upload goes on to its activation check right away, instead of waiting for the other uploads.
+    """
+    file_names, uploaded_files = await upload
+    await asyncio.gather(*(wait_for_file_active(uploaded_file, client) for uploaded_file in uploaded_files))
+    return file_names, uploaded_files
+
+async def handle_youtube(link, client: httpx.AsyncClient):
     try:
-        video_file = await asyncio.to_thread(download_video, link.group(0))
+        # Download from the canonical URL, whichever form of link was posted
+        video_file = await asyncio.to_thread(download_video, f"https://www.youtube.com/watch?v={link.group(1)}")
         
         logging.info(f"Downloaded The Video {os.path.basename(video_file)}")
         
@@ -60,7 +124,7 @@ async def handle_youtube(link):
         uploaded_files = []
         
         file_names.extend([video_file])
-        uploaded_youtube_file = await asyncio.to_thread(genai.upload_file, video_file)
+        uploaded_youtube_file = await upload_file(video_file, client)
         uploaded_files.append(uploaded_youtube_file)
         
         logging.info(f"Uploaded {uploaded_youtube_file.display_name} as {uploaded_youtube_file.name}")
@@ -70,7 +134,7 @@ async def handle_youtube(link):
         logging.error(f"Error in handleYoutube: {e}")
         return [], [] # Return empty lists to indicate failure
 
-async def handle_attachment(attachment):
+async def handle_attachment(attachment, client: httpx.AsyncClient):
     try:
         file_extension = attachment.filename.split(".")[-1]
         unique_file_name = generate_unique_file_name(file_extension)
@@ -83,7 +147,7 @@ async def handle_attachment(attachment):
         uploaded_files = []
         
         file_names.append(file_name)
-        uploaded_file = await asyncio.to_thread(genai.upload_file, file_name)
+        uploaded_file = await upload_file(file_name, client)
         uploaded_files.append(uploaded_file)
         
         logging.info(f"Uploaded {uploaded_file.display_name} as {uploaded_file.name}")
@@ -0,0 +1,31 @@
+import pytest
+
+from packages.constants import YOUTUBE_PATTERN
+
+
+@pytest.mark.parametrize("text, link, video_id", [
+    ("watch https://www.youtube.com/watch?v=dQw4w9WgXcQ now", "https://www.youtube.com/watch?v=dQw4w9WgXcQ", "dQw4w9WgXcQ"),
+    ("https://youtu.be/dQw4w9WgXcQ?si=abc", "https://youtu.be/dQw4w9WgXcQ?si=abc", "dQw4w9WgXcQ"),
+    ("m.youtube.com/shorts/dQw4w9WgXcQ", "m.youtube.com/shorts/dQw4w9WgXcQ", "dQw4w9WgXcQ"),
+    ("https://www.youtube.com/watch?feature=share&v=dQw4w9WgXcQ&t=10",
+     "https://www.youtube.com/watch?feature=share&v=dQw4w9WgXcQ&t=10", "dQw4w9WgXcQ"),
+    ("(https://www.youtube-nocookie.com/embed/dQw4w9WgXcQ)", "https://www.youtube-nocookie.com/embed/dQw4w9WgXcQ",
+     "dQw4w9WgXcQ"),
+])
+def test_matches_links(text, link, video_id):
+    match = YOUTUBE_PATTERN.search(text)
+    assert match.group(0) == link
+    assert match.group(1) == video_id
+
+
+@pytest.mark.parametrize("text", [
+    # Inside another host name
+    "https://notyoutube.com/watch?v=dQw4w9WgXcQ",
+    "https://www.notyoutu.be/dQw4w9WgXcQ",
+    "https://youtube.com.evil/x https://my-youtube.com/watch?v=dQw4w9WgXcQ",
+    # Video ID longer than 11 characters
+    "https://youtu.be/dQw4w9WgXcQxyz",
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ-extra",
+])
+def test_ignores_lookalikes(text):
+    assert YOUTUBE_PATTERN.search(text) is None